@@ -1,49 +1,50 @@
-from dagster import asset, EnvVar, OpExecutionContext
-from dagster_aws.s3 import S3Resource
+from dagster import asset, OpExecutionContext, ResourceParam, StaticPartitionsDefinition
 from cl_wrappers_aws.resources.api_scraper import APIScraper, CLScraper
 
-# Load environment variables
-api_token_var = EnvVar("API_TOKEN")
+# Each partition scrapes one range of pages, so Dagster can materialize the ranges in parallel
+# The ranges line up with num_pages_to_save so every partition writes exactly one page_bucket of the parquet dataset
+position_page_partitions = StaticPartitionsDefinition(["1-5", "6-10", "11-15", "16-20"])
 
-@asset
-def position_csv_files(context:OpExecutionContext, s3: S3Resource) -> dict:
-    # Retrieve the api token
-    api_token = api_token_var.get_value()
+# Both scrape assets hit the same API, so they share the slots of one concurrency key (see dagster.yaml)
+COURTLISTENER_OP_TAGS = {"dagster/concurrency_key": "courtlistener_api"}
 
-    # Create the CLScraper object
-    cl_scraper = CLScraper(api_token=api_token,context=context)
-    
+# Cursor pagination (the API's default ordering) cannot jump to a page, so partitions
+# order by a non-cursor field; id breaks ties so pages don't overlap
+POSITIONS_PAGE_ORDERING = "date_start,id"
+
+@asset(partitions_def=position_page_partitions, op_tags=COURTLISTENER_OP_TAGS)
+def position_csv_files(context:OpExecutionContext, cl_scraper: ResourceParam[CLScraper]) -> dict:
     # Define storage type 
     storage_type = 'local'
 
+    # Read the page range for this partition, e.g. "6-10"
+    start_page, end_page = (int(page) for page in context.partition_key.split("-"))
+
     # Log start of the process
-    context.log.info("Starting position data extraction...")
+    context.log.info(f"Starting position data extraction for pages {start_page} to {end_page}...")
     cl_scraper.fetch_positions(
         context=context,
         is_author_based=False, 
         save_logic= 'save_after_pages', # Possible options are 'author_level' or 'save_after_pages'
         num_pages_to_save = 5,
-        max_pages=20,
+        start_page=start_page,
+        end_page=end_page,
         storage_type=storage_type,  # or 'local' depending on your setup
+        file_format='parquet',  # Each partition writes its page range into data/positions/dataset
         s3_bucket=None,
         s3_key=None,
+        params={"order_by": POSITIONS_PAGE_ORDERING},
         # Add any additional parameters if needed
     )
-    context.log.info("Position data extraction completed.")
+    context.log.info(f"Position data extraction for pages {start_page} to {end_page} completed.")
     # Return metadata: temporary fix to handle dependency in clean_positions_dataframe
     return {
         "storage_type": storage_type
     }
 
 
-@asset
-def financial_disclosures_csv_files(context:OpExecutionContext, s3: S3Resource) -> None:
-    # Retrieve the api token
-    api_token = api_token_var.get_value()
-
-    # Create the CLScraper object
-    cl_scraper = CLScraper(api_token=api_token,context=context)
-    
+@asset(op_tags=COURTLISTENER_OP_TAGS)
+def financial_disclosures_csv_files(context:OpExecutionContext, cl_scraper: ResourceParam[CLScraper]) -> None:
     # Log start of the process
     context.log.info("Starting financial disclosures data extraction...")
     cl_scraper.fetch_disclosures(
@@ -1,51 +1,195 @@
-from dagster import asset, EnvVar, OpExecutionContext
+from dagster import asset, AutomationCondition, DataVersion, EnvVar, MaterializeResult, OpExecutionContext
 from dagster_aws.s3 import S3Resource
 
 # Import necessary libraries for visualization and EDA
-import os
 import pandas as pd
-import matplotlib.pyplot as plt
-import glob
-import json
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+import pyarrow.json as pajson
+import pyarrow.parquet as pq
 import ast
+import orjson
+import hashlib
+import re
+from io import BytesIO
+from pathlib import Path
 
 ROOT_DIR = "cl_wrappers_aws"
+# The scraper writes the positions as a parquet dataset with one partition per page range
+POSITIONS_DATASET_DIR = Path(ROOT_DIR, "data", "positions", "dataset")
+# Csv files scraped before the dataset existed sit one level up and are read alongside it
+LEGACY_POSITIONS_DIR = Path(ROOT_DIR, "data", "positions")
+INTERMEDIATE_DIR = Path(ROOT_DIR, "data", "intermediate_dfs")
+
+# dataset_version reads each file in blocks of this many bytes
+VERSION_READ_BLOCK_SIZE = 1 << 20
+
+# Columns of the positions data used by the downstream assets, all stored as strings
+POSITIONS_DTYPES = {
+    "id": "string",
+    "person": "string",
+    "court": "string",
+    "position_type": "string",
+    "job_title": "string",
+    "organization_name": "string",
+    "date_start": "string",
+    "date_termination": "string",
+}
+POSITIONS_USECOLS = list(POSITIONS_DTYPES)
+POSITIONS_SCHEMA = pa.schema([(column, pa.string()) for column in POSITIONS_USECOLS])
+
+# Rows of the legacy csv files that can't be parsed are skipped instead of failing the scan
+LEGACY_CSV_FORMAT = ds.CsvFileFormat(
+    parse_options=pcsv.ParseOptions(newlines_in_values=True, invalid_row_handler=lambda row: "skip"),
+    convert_options=pcsv.ConvertOptions(strings_can_be_null=True),  # Empty cells are nulls, like in the dataset
+)
+
+# Fields extracted from the 'person' column, mapped to the name of their output column
+PERSON_FIELDS = {
+    "id": "person_id",
+    "slug": "full_name",
+    "name_first": "name_first",
+    "name_middle": "name_middle",
+    "name_last": "name_last",
+    "name_suffix": "name_suffix",
+    "gender": "gender",
+    "race": "race",
+    "religion": "religion",
+}
+
+# Types of the person fields; the Arrow JSON reader only decodes these and skips the rest of each person
+PERSON_PARSE_OPTIONS = pajson.ParseOptions(
+    explicit_schema=pa.schema([
+        ("id", pa.int64()),
+        ("slug", pa.string()),
+        ("name_first", pa.string()),
+        ("name_middle", pa.string()),
+        ("name_last", pa.string()),
+        ("name_suffix", pa.string()),
+        ("gender", pa.string()),
+        ("race", pa.list_(pa.string())),
+        ("religion", pa.string()),
+    ]),
+    unexpected_field_behavior="ignore",
+)
 
+# Python literals that are spelled differently in JSON; only replaced outside of quoted strings
+PYTHON_LITERALS = re.compile(r"\b(None|True|False)\b")
+JSON_LITERALS = {"None": "null", "True": "true", "False": "false"}
 
-@asset
+# Low cardinality person fields stored as categories; race is left out because it holds a list of codes
+PERSON_CATEGORY_FIELDS = ["gender", "religion"]
+
+
+def positions_dataset():
+    '''
+    Return a single dataset over the scraped parquet partitions and any legacy csv files, projected to POSITIONS_SCHEMA.
+    '''
+    sources = []
+    if POSITIONS_DATASET_DIR.exists():
+        sources.append(ds.dataset(str(POSITIONS_DATASET_DIR), schema=POSITIONS_SCHEMA, format="parquet", partitioning="hive"))
+    # Arrow decompresses the .csv.zstd batches based on their extension
+    legacy_files = sorted(
+        str(path) for pattern in ("*.csv", "*.csv.zstd") for path in LEGACY_POSITIONS_DIR.glob(pattern)
+    )
+    if legacy_files:
+        sources.append(ds.dataset(legacy_files, schema=POSITIONS_SCHEMA, format=LEGACY_CSV_FORMAT))
+    if not sources:
+        raise FileNotFoundError(f"No positions data found in {LEGACY_POSITIONS_DIR}")
+    return ds.dataset(sources)
+
+
+def dataset_version(dataset):
+    '''
+    Return a hash of the path and contents of every file in the dataset.
+    The scraper rewrites a partition on every run, so the hash is taken over the bytes rather than the
+    modification times and only changes when the pages in a partition do.
+    '''
+    digest = hashlib.md5()
+    for path in sorted(Path(file) for child in dataset.children for file in child.files):
+        digest.update(f"{path}\0".encode())
+        with open(path, "rb") as file:
+            while block := file.read(VERSION_READ_BLOCK_SIZE):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_person(value):
+    '''
+    Parse a 'person' cell into a dictionary. The scraper stores it as JSON, older files hold a python dict literal.
+    '''
+    if not isinstance(value, str) or not value.strip():
+        return {}
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        pass
+    # Without double quotes or escapes, every single quote of a dict literal delimits a string, so swapping
+    # the quotes and the literals between the strings gives valid JSON, which orjson parses far faster than ast
+    if '"' in value or "\\" in value:
+        return ast.literal_eval(value)
+    segments = value.split("'")
+    segments[::2] = [
+        PYTHON_LITERALS.sub(lambda match: JSON_LITERALS[match.group(1)], segment) for segment in segments[::2]
+    ]
+    try:
+        return orjson.loads('"'.join(segments))
+    except orjson.JSONDecodeError:
+        return ast.literal_eval(value)
+
+
+def parse_persons(values, context):
+    '''
+    Parse the 'person' column into a dataframe with one column per PERSON_FIELDS key.
+    The JSON cells are decoded together by the Arrow JSON reader; a column holding python dict literals
+    from older files falls back to parse_person row by row.
+    '''
+    # One JSON object per line, with empty objects for missing or blank persons so the rows stay aligned;
+    # the reader skips blank lines
+    lines = "\n".join(value if isinstance(value, str) and value.strip() else "{}" for value in values)
+    try:
+        table = pajson.read_json(BytesIO(lines.encode()), parse_options=PERSON_PARSE_OPTIONS)
+    except pa.ArrowInvalid:
+        table = None
+    if table is None or table.num_rows != len(values):
+        context.log.info("The 'person' column is not JSON, parsing it row by row...")
+        person_df = pd.json_normalize(values.map(parse_person).tolist(), max_level=0)
+        return person_df.reindex(columns=list(PERSON_FIELDS))
+    return table.select(list(PERSON_FIELDS)).to_pandas()
+
+
+# The data version only changes when the scraped dataset does, so re-runs on unchanged pages don't mark
+# the downstream assets as stale; bump code_version when the logic below changes
+@asset(
+    code_version="v1",
+    automation_condition=AutomationCondition.any_downstream_conditions()
+)
 def consolidated_position_and_title(
     context: OpExecutionContext, 
     position_csv_files: dict # Adding dependency for positions metadata
-    ) -> None:
+    ) -> MaterializeResult:
     '''
-    This function reads the position data, cleans it, and saves it back as a csv.
+    This function reads the position data, cleans it, and saves it as a parquet file.
     '''
     
     # Check storage type from metadata
-    # Extract storage type and data directory from the dictionary
-    storage_type = position_csv_files.get("storage_type", "local")  # Default to 'local' if not specified
+    # position_csv_files is partitioned by page range, so the input maps each partition key to its metadata
+    partition_metadata = next(iter(position_csv_files.values()), {})
+    storage_type = partition_metadata.get("storage_type", "local")  # Default to 'local' if not specified
 
     # Load the data
     if storage_type == 's3':
         context.log.info("Loading data from S3 is not implemented yet.")
-        pass  # Future logic for loading from S3
+        data_version = None  # Future logic for loading from S3
     else:
         # Load data from local storage
         context.log.info("Loading data from local storage...")
-        data_dir = os.path.join(ROOT_DIR, "data", "positions")
-        files = glob.glob(data_dir + "/*.csv")
-    
-    li = []
-    for filename in files:
-        try:
-            context.log.info(f"Reading file {filename}...")
-            df = pd.read_csv(filename, index_col=None, header=0)
-            li.append(df)
-        except Exception as e:
-            context.log.error(f"Error reading file {filename}: {e}")
-    
-    # Concatenate all dataframes into single dataframe
-    df = pd.concat(li, axis=0, ignore_index=True)
+        dataset = positions_dataset()
+        data_version = DataVersion(dataset_version(dataset))
+        # One multithreaded scan over every file replaces reading the files one by one
+        table = dataset.to_table(columns=POSITIONS_USECOLS)
 
     # For now, the dataframe will be saved in local; we can think of saving it in S3 later
     if storage_type == 's3':
@@ -54,12 +198,21 @@ def consolidated_position_and_title(
     else:
         # Save the dataframe in local storage
         context.log.info("Saving the dataframe in local storage...")
-        desired_path = os.path.join(ROOT_DIR, "data", "intermediate_dfs")
-        if not os.path.exists(desired_path):
-            os.makedirs(desired_path)
-        # Save the dataframe
-        df.to_csv(os.path.join(desired_path, "consolidated_positions.csv"), index=False)
-        context.log.info(f"Dataframe has {df.shape[0]} rows and saved successfully.")
+        INTERMEDIATE_DIR.mkdir(parents=True, exist_ok=True)
+
+        # The table goes straight from the dataset to the output file without a pandas round trip
+        # position_type has few distinct values, so it is dictionary encoded and read back as a category
+        table = table.cast(POSITIONS_SCHEMA)
+        table = table.set_column(
+            table.schema.get_field_index("position_type"),
+            "position_type",
+            pc.dictionary_encode(table["position_type"])
+        )
+        output_file = INTERMEDIATE_DIR / "consolidated_positions.parquet"
+        pq.write_table(table, output_file, compression="zstd")
+        context.log.info(f"Dataframe has {table.num_rows} rows and saved successfully.")
+
+    return MaterializeResult(data_version=data_version)
 
 @asset(
     deps=["consolidated_position_and_title"]
@@ -68,42 +221,37 @@ def positions_data_with_persons_info(
     context: OpExecutionContext
     ) -> None:
     '''
-    This function extracts person information from the positions data and saves a new csv
+    This function extracts person information from the positions data and saves it as a parquet file keyed by position id
     '''
     # Load the consolidated positions dataframe
-    file_name = "consolidated_positions.csv"
-    data_path = os.path.join(ROOT_DIR, "data", "intermediate_dfs", file_name)
-    df = pd.read_csv(data_path)
+    # Only the position id and the 'person' column are read; the other columns stay in the consolidated file
+    data_path = INTERMEDIATE_DIR / "consolidated_positions.parquet"
+    df = pd.read_parquet(data_path, columns=["id", "person"], engine="pyarrow")
 
     # Extract person information from the 'person' column
-    # Check if the 'person' column is a string and try to convert it back to a dictionary
-    df['person'] = df['person'].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-    
-    # Now you can safely access the 'id' field
-    df['person_id'] = df['person'].apply(lambda x: x.get('id') if pd.notnull(x) else None)
-    df['full_name'] = df['person'].apply(lambda x: x.get('slug') if pd.notnull(x) else None)
-    df['name_first'] = df['person'].apply(lambda x: x.get('name_first') if pd.notnull(x) else None)
-    df['name_middle'] = df['person'].apply(lambda x: x.get('name_middle') if pd.notnull(x) else None)
-    df['name_last'] = df['person'].apply(lambda x: x.get('name_last') if pd.notnull(x) else None)
-    df['name_suffix'] = df['person'].apply(lambda x: x.get('name_suffix') if pd.notnull(x) else None)
-    df['gender'] = df['person'].apply(lambda x: x.get('gender') if pd.notnull(x) else None)
-    df['race'] = df['person'].apply(lambda x: x.get('race') if pd.notnull(x) else None)
-    df['religion'] = df['person'].apply(lambda x: x.get('religion') if pd.notnull(x) else None)
-
-    # Save the new dataframe with person info
-    output_file = os.path.join(ROOT_DIR, "data", "intermediate_dfs", "positions_with_person_info.csv")
-    df.to_csv(output_file, index=False)
+    # All the fields are pulled out in a single pass over the column
+    person_df = parse_persons(df['person'], context).rename(columns=PERSON_FIELDS)
+    person_df = person_df.astype({field: "category" for field in PERSON_CATEGORY_FIELDS})
+    person_df.insert(0, "position_id", df["id"].to_numpy())
+
+    # Save the person info; it is joined back onto the positions on position_id
+    output_file = INTERMEDIATE_DIR / "person_info.parquet"
+    person_df.to_parquet(output_file, index=False, engine="pyarrow", compression="zstd")
 
     context.log.info(f"Processed data saved to {output_file}")
 
 '''
-@asset
+@asset(
+    deps=["positions_data_with_persons_info"]
+)
 def positions_and_persons_data_with_judge_flag(
     context: OpExecutionContext, 
-    positions_data_with_persons_info: pd.DataFrame,
     s3: S3Resource = None
     ) -> pd.DataFrame:
-    df = positions_data_with_persons_info
+    # Join the person info back onto the positions it was extracted from
+    positions = pd.read_parquet(INTERMEDIATE_DIR / "consolidated_positions.parquet", columns=["id", "position_type", "job_title"])
+    person_info = pd.read_parquet(INTERMEDIATE_DIR / "person_info.parquet")
+    df = positions.merge(person_info, left_on="id", right_on="position_id", how="left")
     # Create the 'position' column by combining 'position_type' and 'job_title'
     df['position'] = df['position_type'].fillna('') + ' ' + df['job_title'].fillna('')
     df['position'] = df['position'].str.lower().str.strip()
@@ -119,14 +267,18 @@ def positions_and_persons_data_with_judge_flag(
     context.log.info(f"Total unique positions with 'judge_flag' = 1: {df[df['judge_flag'] == 1]['position'].nunique()}")
     
     # Save the dataframe in local storage
-    desired_path = os.path.join(ROOT_DIR, "data", "intermediate_dfs")
     # Save the dataframe
-    df.to_csv(os.path.join(desired_path, "positions_with_judge_flag.csv"), index=False)
+    df.to_csv(INTERMEDIATE_DIR / "positions_with_judge_flag.csv", index=False)
     return df
 
 
 @asset
 def positions_summary_stats(context, positions_and_persons_data_with_judge_flag: pd.DataFrame) -> None:
+    # matplotlib is only imported by the asset that plots, so other runs don't pay for its import
+    # The Agg backend renders to files without probing for a GUI
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
 
     df = positions_and_persons_data_with_judge_flag
 
@@ -175,10 +327,9 @@ def positions_summary_stats(context, positions_and_persons_data_with_judge_flag:
     plt.show()
 
     # Save the plot as an image in local storage
-    desired_path = os.path.join(ROOT_DIR, "data", "positions","intermediate_dfs","images")
-    if not os.path.exists(desired_path):
-        os.makedirs(desired_path)
-    plt.savefig(os.path.join(desired_path, "positions_distribution_overall.png"))
+    desired_path = Path(ROOT_DIR, "data", "positions", "intermediate_dfs", "images")
+    desired_path.mkdir(parents=True, exist_ok=True)
+    plt.savefig(desired_path / "positions_distribution_overall.png")
 
 
     # Now let's filter for judges with other positions
@@ -199,7 +350,7 @@ def positions_summary_stats(context, positions_and_persons_data_with_judge_flag:
     plt.show()
 
     # Save the plot as an image in local storage
-    plt.savefig(os.path.join(desired_path, "judges_with_other_positions_distribution.png"))
+    plt.savefig(desired_path / "judges_with_other_positions_distribution.png")
 
 
 #@asset
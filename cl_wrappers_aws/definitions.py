@@ -1,4 +1,5 @@
 from dagster import (
+    AssetSelection,
     Definitions,
     EnvVar,
     ScheduleDefinition,
@@ -8,12 +9,23 @@ from dagster import (
 from dagster_aws.s3 import S3PickleIOManager, S3Resource
 
 from . import assets
-#from .resources import cl_scraper_resource
+from .resources import cl_scraper_resource
 
 #daily_refresh_schedule = ScheduleDefinition(
 #    job=define_asset_job(name="all_assets_job"), cron_schedule="0 0 * * *"
 #)
 
+# Backfilling this job launches one run per page range; the QueuedRunCoordinator in
+# dagster.yaml caps how many of them hit the CourtListener API at the same time
+position_pages_job = define_asset_job(
+    name="position_pages_job",
+    selection=AssetSelection.assets("position_csv_files"),
+    tags={
+        "dagster/max_runtime": 60 * 60,  # Fail runs that are stuck for more than an hour
+        "courtlistener_api": "true",  # Limited by tag_concurrency_limits in dagster.yaml
+    },
+)
+
 my_s3_resource = S3Resource()
 
 defs = Definitions(
@@ -31,7 +43,9 @@ defs = Definitions(
             s3_bucket=EnvVar("S3_BUCKET"),
         ),
         "s3": my_s3_resource,
-        #"cl_scraper_resource": resources.cl_scraper_resource
+        # Every scrape step gets its own CourtListener scraper, closed when the step is done
+        "cl_scraper": cl_scraper_resource.configured({"api_token": {"env": "API_TOKEN"}}),
     },
+    jobs=[position_pages_job],
     #schedules=[daily_refresh_schedule],
 )
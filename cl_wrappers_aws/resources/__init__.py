@@ -1,5 +1,5 @@
 from dagster import EnvVar
-from .api_scraper import CLScraper, APIScraper
+from .api_scraper import CLScraper, APIScraper, cl_scraper_resource
 
 # #EnvVar defers resolution of the environment variable value until run time, 
 # and should only be used as input to Dagster config or resources.
@@ -10,22 +10,199 @@
 
 
 import os
+import socket
 import requests
-import logging
-import pandas as pd
+import requests_cache
 import json
+import orjson
+import zstandard as zstd
 import csv
 import time
-from dagster_aws.s3 import S3Resource
-from io import BytesIO, StringIO
+import threading
+from collections import deque, namedtuple
+import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.fs as pafs
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+from boto3.s3.transfer import TransferConfig
+from io import TextIOWrapper
+from dagster import Field, IntSource, resource, StringSource
 
 # These variables can be stored as resources in Dagster
 ROOT_DIR = "cl_wrappers_aws"
 BASE_URL = "https://www.courtlistener.com/api/rest/v4/"
 
+# API responses are cached on disk so re-running an asset doesn't re-fetch unchanged pages
+CACHE_PATH = os.path.join(ROOT_DIR, "data", "cl_api_cache.sqlite")
+CACHE_EXPIRE_AFTER = 24 * 60 * 60  # seconds
+# Headers and query params that don't change the response, so they are left out of the cache key
+CACHE_IGNORED_PARAMETERS = ["Authorization", "timestamp", "_"]
+
+# The API limit applies to any rolling hour, not to clock hours
+RATE_LIMIT_WINDOW = 60 * 60  # seconds
+
+# Seconds to wait for a connection and for the response to each request
+REQUEST_TIMEOUT = (5, 30)
+
+# Batches are uploaded to S3 in 8 MiB parts, 8 at a time; smaller batches go up in a single PUT
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=8
+)
+# CSVs up to this size are built in memory before uploading, larger ones spill to a temporary file
+S3_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# CSV batches are zstd compressed; flattened records shrink several times over at level 3
+ZSTD_LEVEL = 3
+# Arrow only infers the zstd codec from a ".zstd" extension, not ".zst", when reading the files back
+CSV_ZSTD_SUFFIX = ".zstd"
+
+# Progress of a fetch: the last saved page, its url and the url to resume from. Starts on page 1 without urls
+Checkpoint = namedtuple("Checkpoint", ["url", "next", "page"], defaults=[None, None, 1])
+
+# Number of page numbered urls kept in flight at the same time over the session's connection pool
+MAX_PAGES_IN_FLIGHT = 16
+
+
+def batch_s3_key(s3_key, filename):
+    """Return the key of a CSV batch under the s3_key prefix, named like the local file."""
+    if not s3_key:
+        return None
+    return f"{s3_key}/{os.path.basename(filename)}{CSV_ZSTD_SUFFIX}"
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets keep urllib3's defaults (TCP_NODELAY) and also send TCP keepalives,
+    so connections left idle while the scraper waits on the rate limit aren't silently dropped."""
+
+    SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self.SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
+
+
+class CSVBatchWriter:
+    """Writes the pages of one batch to a zstd compressed CSV as they are fetched.
+    Local batches are written next to filename + CSV_ZSTD_SUFFIX and moved into place on close, so a batch
+    that fails keeps the file of the last complete run; S3 batches are spooled and uploaded to s3_key on close.
+    The header is taken from the first page with records."""
+
+    def __init__(self, filename, storage_type='local', s3_client=None, s3_bucket=None, s3_key=None):
+        self.storage_type = storage_type
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        if storage_type == 's3':
+            self.path = f"s3://{s3_bucket}/{s3_key}"
+            self.raw_file = tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_MAX_SIZE, mode="w+b")
+        else:
+            self.path = filename + CSV_ZSTD_SUFFIX
+            self.temp_path = self.path + ".tmp"
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.raw_file = open(self.temp_path, "wb", buffering=1 << 20)
+        compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+        # closefd=False ends the zstd frame on close but leaves raw_file open for the upload
+        self.text_file = TextIOWrapper(
+            compressor.stream_writer(self.raw_file, closefd=False), encoding="utf-8", newline=""
+        )
+        self.writer = None
+
+    def write(self, records):
+        """Append the records of one page to the batch."""
+        if not records:
+            return
+        if self.writer is None:
+            fieldnames = list(dict.fromkeys(key for item in records for key in item))
+            self.writer = csv.DictWriter(self.text_file, fieldnames=fieldnames, restval=None, extrasaction="ignore")
+            self.writer.writeheader()
+        self.writer.writerows(records)
+
+    def close(self):
+        """Finish the batch. Returns False, and leaves no file behind, if no page had records."""
+        if self.writer is None:
+            self.discard()
+            return False
+        self.text_file.close()
+        if self.storage_type == 's3':
+            self.raw_file.seek(0)
+            self.s3_client.upload_fileobj(
+                self.raw_file, self.s3_bucket, self.s3_key,
+                ExtraArgs={"ContentEncoding": "zstd", "ContentType": "text/csv"},
+                Config=S3_TRANSFER_CONFIG,
+            )
+        self.raw_file.close()
+        if self.storage_type != 's3':
+            os.replace(self.temp_path, self.path)
+        return True
+
+    def discard(self):
+        """Drop a batch that was not fetched completely, keeping the file of the last complete run."""
+        self.text_file.close()
+        self.raw_file.close()
+        if self.storage_type != 's3':
+            os.remove(self.temp_path)
+
+
+class ParquetBatchWriter:
+    """Writes the pages of one batch to the page_bucket partition of a parquet dataset as they are fetched.
+    Values are stored as strings, the same as in the CSV files, so every partition has the same schema.
+    The partition is written to a temporary file and moved into place on close, so a batch that fails
+    keeps the file of the last complete run. The columns are taken from the first page with records."""
+
+    def __init__(self, base_dir, page_bucket, storage_type='local', s3_bucket=None, s3_key=None):
+        if storage_type == 's3':
+            # Arrow uploads the partition file itself, reading credentials from the standard AWS environment
+            self.filesystem = pafs.S3FileSystem()
+            base_dir = f"{s3_bucket}/{s3_key}"
+        else:
+            self.filesystem = pafs.LocalFileSystem()
+        self.partition_dir = f"{base_dir}/page_bucket={page_bucket}"
+        # Re-fetching a page range replaces its file. The dot keeps the temporary file out of dataset scans
+        self.path = f"{self.partition_dir}/part-0.parquet"
+        self.temp_path = f"{self.partition_dir}/.part-0.parquet.tmp"
+        self.schema = None
+        self.writer = None
+
+    def write(self, records):
+        """Append the records of one page to the partition as a row group."""
+        if not records:
+            return
+        if self.writer is None:
+            fieldnames = list(dict.fromkeys(key for item in records for key in item))
+            self.schema = pa.schema([(key, pa.string()) for key in fieldnames])
+            self.filesystem.create_dir(self.partition_dir, recursive=True)
+            self.writer = pq.ParquetWriter(
+                self.temp_path, self.schema, filesystem=self.filesystem, compression="zstd"
+            )
+        columns = {
+            key: [None if item.get(key) is None else str(item.get(key)) for item in records]
+            for key in self.schema.names
+        }
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        """Finish the partition. Returns False if no page had records."""
+        if self.writer is None:
+            return False
+        self.writer.close()
+        self.filesystem.move(self.temp_path, self.path)
+        return True
+
+    def discard(self):
+        """Drop a partition that was not fetched completely, keeping the file of the last complete run."""
+        if self.writer is not None:
+            self.writer.close()
+            self.filesystem.delete_file(self.temp_path)
+
+
 class APIScraper:
     def __init__(
-        self, base_url, api_token=None, max_requests_per_hour=5000, log_dir="logs",context=None):
+        self, base_url, api_token=None, max_requests_per_hour=5000, log_dir="logs",context=None, s3_client=None):
         """
         Initialize the APIScraper.
 
@@ -34,31 +211,69 @@ class APIScraper:
             api_token (str, optional): The API token for authentication. Defaults to None.
             max_requests_per_hour (int, optional): Maximum number of requests allowed per hour. Defaults to 5000.
             log_dir (str, optional): Directory for storing logs. Defaults to "logs".
+            s3_client (optional): boto3 S3 client used when storage_type is 's3', e.g. S3Resource.get_client().
         """
+        # wait_for_rate_limit needs at least one request in the window to wait on
+        if max_requests_per_hour < 1:
+            raise ValueError(f"max_requests_per_hour must be at least 1, got {max_requests_per_hour}")
         self.base_url = base_url
         self.api_token = api_token
         self.max_requests_per_hour = max_requests_per_hour
-        self.request_count = 0
+        self._request_times = deque()  # When each request of the last RATE_LIMIT_WINDOW counted against the limit
+        self._request_times_lock = threading.Lock()  # The prefetch workers record their requests too
         self.log_dir = log_dir
         self.log_file = None  # Initialize the log file path
+        self._checkpoint = None  # Progress of the current fetch, written to the log file with each saved batch
         self.context = context
+        self.s3_client = s3_client
+        self._data_dirs = {}  # Data directory of each endpoint, created on first use
+        self._batch_writer = None  # Writer of the batch of pages being fetched
         self.session = self.make_session(api_token,context)
+        # Fetches pages ahead of the one being processed, sharing the session's keep-alive connections
+        self.executor = ThreadPoolExecutor(max_workers=MAX_PAGES_IN_FLIGHT)
 
         # Create log directory if it does not exist
         os.makedirs(log_dir, exist_ok=True)
 
+    def close(self):
+        """Close the session's pooled connections and stop the prefetch workers."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
     def make_session(self, api_token,context):
         """
         Create and return a session with the required headers, using Dagster's logging.
+        GET responses are cached in a local SQLite file and failed requests are retried
+        with exponential backoff by the session's adapter.
 
         Args:
             api_token (str): The API token for authentication.
 
         Returns:
-            requests.Session: A session object with the appropriate headers.
+            requests_cache.CachedSession: A session object with the appropriate headers.
         """
         context.log.info("Creating a new session...")
-        session = requests.Session()
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        session = requests_cache.CachedSession(
+            CACHE_PATH,
+            backend="sqlite",
+            expire_after=CACHE_EXPIRE_AFTER,
+            allowable_methods=("GET",),
+            ignored_parameters=CACHE_IGNORED_PARAMETERS,
+        )
+
+        # Retry rate limited and server side errors right away, then after 3s, 6s, 12s, ...
+        # unless the server says how long to wait in a Retry-After header
+        retries = Retry(
+            total=5,
+            backoff_factor=1.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+        )
+        # The pool keeps a connection for every page in flight, so retries and parallel pages reuse open sockets
+        adapter = KeepAliveHTTPAdapter(pool_connections=4, pool_maxsize=64, max_retries=retries)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
         if api_token:
             session.headers.update({"Authorization": f"Token {api_token}"})
         context.log.info("Session created successfully!")
@@ -66,35 +281,44 @@ class APIScraper:
 
     def set_data_directory(self, endpoint, context):
         """Creates a data directory inside root directory for the endpoint if it doesn't exist already"""
-        
+        # Every batch of an endpoint is saved to the same directory, so it is only created once
+        if endpoint in self._data_dirs:
+            return self._data_dirs[endpoint]
+
         # Define the data directory inside cl_wrappers_aws
         data_dir = os.path.join(ROOT_DIR, "data", endpoint)
 
         # Create the data directory if it doesn't exist
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
+        os.makedirs(data_dir, exist_ok=True)
 
         context.log.info(f"Data directory set to {data_dir}")
+        self._data_dirs[endpoint] = data_dir
         return data_dir
 
-    def create_log_file(self, endpoint, is_author_based=False, author_id=None,context=None):
+    def create_log_file(self, endpoint, is_author_based=False, author_id=None,context=None,page_range=None):
         """Create a log file based on the endpoint or author ID
         Args:
             endpoint (str): The API endpoint to fetch data from.
             is_author_based (bool, optional): Whether to create a log file per author. Defaults to False.
             author_id (int, optional): The author ID to include in the log file name if is_author_based is True.
+            page_range (str, optional): The page range to include in the log file name, e.g. 'pages_1_to_5'.
         """
         # Determine the log filename based on whether it's author-based
         if is_author_based and author_id:
             log_filename = (
-                f"{endpoint}_author_{author_id}_log.txt"  # Log file for each author
+                f"{endpoint}_author_{author_id}_log.json"  # Log file for each author
+            )
+        elif page_range:
+            log_filename = (
+                f"{endpoint}_{page_range}_log.json"  # Log file for each page range
             )
         else:
             log_filename = (
-                f"{endpoint}_log.txt"  # Default log file for the entire endpoint
+                f"{endpoint}_log.json"  # Default log file for the entire endpoint
             )
         log_path = os.path.join(self.log_dir, log_filename)
         self.log_file = log_path
+        self._checkpoint = None  # Read from the new log file on first use
 
         # Create the file if it doesn't exist, but don't write anything to it
         if not os.path.exists(log_path):
@@ -117,13 +341,35 @@ class APIScraper:
         next_url, 
         page_number,
         context):
-        """Save the next URL and the last successfully fetched page number to the log file."""
-        with open(self.log_file, "w") as f:
-            f.write(f"Current URL: {url}\n")
-            f.write(f"Next URL: {next_url}\n")
-            f.write(f"Last successfully fetched page: {page_number}\n")
+        """Keep the current URL, next URL and last successfully fetched page number in memory.
+        They are written to the log file by _flush_checkpoint once the page's batch is saved.
+        """
+        self._checkpoint = Checkpoint(url, next_url, page_number)
+
+    def _flush_checkpoint(self, context):
+        """Write the in-memory checkpoint to the log file.
+        The file is replaced in one step so a resumed run never reads a half written checkpoint.
+        """
+        tmp_file = self.log_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._checkpoint._asdict(), f)
+        os.replace(tmp_file, self.log_file)
         context.log.info(f"Current, next URL and page number saved to {self.log_file}")
 
+    def _load_checkpoint(self):
+        """Load the checkpoint from the log file, once per log file.
+        Returns:
+        Checkpoint: The url, next url and page of the last saved batch, or an empty Checkpoint to start over
+        """
+        if self._checkpoint is not None:
+            return self._checkpoint
+        try:
+            with open(self.log_file, "r") as f:
+                saved = json.load(f)
+            self._checkpoint = Checkpoint(**{field: saved[field] for field in Checkpoint._fields if field in saved})
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._checkpoint = Checkpoint()  # Start over if no valid log file is found
+        return self._checkpoint
 
     # Function to get the last page number fetched
     def get_last_page(self):
@@ -131,41 +377,86 @@ class APIScraper:
         Returns:
         int: The last page number fetched
         """
-        try:
-            with open(self.log_file, "r") as f:
-                log_content = f.read().strip()
-                # The log file contains "Last successfully fetched page: X"
-                last_page_line = [
-                    line
-                    for line in log_content.split("\n")
-                    if "Last successfully fetched page" in line
-                ]
-                if last_page_line:
-                    last_page = int(
-                        last_page_line[0].split(":")[-1].strip()
-                    )  # Extract page number
-                    return last_page
-        except:
-            return 1  # Default to start from page 1 if no valid log file is found
-        return 1  # Default to start from page 1 if no log file is found
+        return self._load_checkpoint().page  # Page 1 if no log file is found
 
     def get_next_url(self):
         """
         Get the next URL from the log file to resume from where we left off.
         """
-        try:
-            with open(self.log_file, "r") as f:
-                log_content = f.read().strip()
-                # The log file contains "Next URL: <url>"
-                next_url_line = [
-                    line for line in log_content.split("\n") if "Next URL:" in line
-                ]
-                if next_url_line:
-                    next_url = next_url_line[0].split("Next URL: ")[-1].strip()
-                    return next_url
-        except:
-            return None  # Default to None if no valid log file is found
-        return None  # Default to None if no log file is found
+        return self._load_checkpoint().next  # None if no log file is found
+
+    def requests_left(self):
+        """Return how many requests can still be made in the current rolling hour, counting requests in flight."""
+        window_start = time.time() - RATE_LIMIT_WINDOW
+        with self._request_times_lock:
+            while self._request_times and self._request_times[0] <= window_start:
+                self._request_times.popleft()
+            return self.max_requests_per_hour - len(self._request_times)
+
+    def reserve_request(self):
+        """Count a request against the hourly limit before it is sent, so pages in flight use up the limit too."""
+        with self._request_times_lock:
+            self._request_times.append(time.time())
+
+    def release_request(self):
+        """Give back a reserved request that never reached the API."""
+        with self._request_times_lock:
+            if self._request_times:
+                self._request_times.pop()
+
+    def settle_request(self, response):
+        """Correct the reservation of a request once its response is in: responses served from the cache
+        don't count, and every retry the adapter made for it counts as one more request."""
+        if getattr(response, "from_cache", False):
+            self.release_request()
+            return
+        retries = getattr(getattr(response, "raw", None), "retries", None)
+        if retries is not None and retries.history:
+            now = time.time()
+            with self._request_times_lock:
+                self._request_times.extend([now] * len(retries.history))
+
+    def wait_for_rate_limit(self, context):
+        """Sleep only until the oldest request of the last hour ages out, if the hourly limit is reached."""
+        if self.requests_left() > 0:
+            return
+        with self._request_times_lock:
+            sleep_for = max(0, self._request_times[0] + RATE_LIMIT_WINDOW - time.time())
+        context.log.info(f"API limit reached. Pausing for {sleep_for / 60:.1f} minutes...")
+        time.sleep(sleep_for)
+
+    def _get_with_retry(self, url):
+        """
+        GET url with the session's retry adapter. The Retry object is copied for every request,
+        so its backoff starts over for each page and a failure on one page never slows down later ones.
+        Raises requests.exceptions.RetryError once all attempts fail.
+        """
+        return self.session.get(url, timeout=REQUEST_TIMEOUT)
+
+    def _fetch_page(self, url):
+        """
+        Fetch url and decode its JSON body, so prefetched pages are decoded by the worker threads
+        while the main thread writes the previous page.
+        The caller reserves the request against the hourly limit first.
+        Returns the response and its data, or None as the data if the request did not succeed.
+        """
+        response = self._get_with_retry(url)
+        self.settle_request(response)
+        data = orjson.loads(response.content) if response.status_code == 200 else None
+        return response, data
+
+    def get_page_number(self, url):
+        """Return the page number of a page numbered url, or None for cursor links and urls without a page."""
+        query = dict(parse_qsl(urlsplit(url).query))
+        page = query.get("page", "")
+        return int(page) if page.isdigit() and "cursor" not in query else None
+
+    def set_page_number(self, url, page_number):
+        """Return the url with its page query parameter set to page_number."""
+        parts = urlsplit(url)
+        query = [(key, value) for key, value in parse_qsl(parts.query) if key != "page"]
+        query.append(("page", page_number))
+        return urlunsplit(parts._replace(query=urlencode(query)))
 
     def fetch_data(
         self, 
@@ -175,8 +466,11 @@ class APIScraper:
         save_logic= 'save_after_pages', # Possible options are 'author_level' or 'save_after_pages'
         num_pages_to_save = None, # Required argument if save_logic is 'save_after_pages'
         max_pages = None,
+        start_page = None,
+        end_page = None,
         return_all_data = False,
         storage_type='local', # or 'cloud' depending on setup
+        file_format='parquet', # or 'csv' to save one csv file per batch of pages
         s3_bucket=None,
         s3_key=None,
         context=None):
@@ -190,7 +484,12 @@ class APIScraper:
             save_logic (str): The logic for saving data. 'author_level' or 'save_after_pages'.
             num_pages_to_save (int, optional): Number of pages after which to save data if save_logic is 'save_after_pages'. 
                                                This is required when save_logic is 'save_after_pages'.
+            start_page (int, optional): First page of a page range to fetch. Requires end_page.
+            end_page (int, optional): Last page of a page range to fetch. A page range is always fetched
+                                      from start_page instead of resuming from the log file.
             return_all_data (bool, optional): Whether to return the full dataset after fetching. Defaults to False.
+            file_format (str, optional): 'parquet' for a parquet dataset partitioned by page range, or 'csv'
+                                         for one csv per batch of pages. Defaults to 'parquet'.
             context: Additional context for log management.
         """
 
@@ -214,33 +513,48 @@ class APIScraper:
         else:
             author_id = None  # Initialize author_id to None when is_author_based is False
 
+        # Page ranges get their own log file so parallel ranges don't overwrite each other's progress
+        page_range = f"pages_{start_page}_to_{end_page}" if start_page and end_page else None
+
         # Create log file based on endpoint or author
         # This abstracts away the need to modify method signature for each request type (author-based or not)
-        self.create_log_file(endpoint, is_author_based, author_id)
+        self.create_log_file(endpoint, is_author_based, author_id, page_range=page_range)
         context.log.info(f"Log file created!")
 
-        # Get the next URL to resume from, if available
-        next_url = self.get_next_url()  
-        url = next_url if next_url else f"{self.base_url}{endpoint}/"
-
         all_data = []
-        # Get the last page number fetched
-        last_fetched_page = self.get_last_page()
-        context.log.info(f"Last fetched page: {last_fetched_page}")
-        if last_fetched_page == 1:
-            page_number = last_fetched_page
+        # The query params are encoded into the first url once. The next links returned by the API
+        # already carry them, so they are never passed to session.get and re-appended to those links
+        if page_range:
+            # Jump straight to the first page of the range
+            url = f"{self.base_url}{endpoint}/?{urlencode({**(params or {}), 'page': start_page})}"
+            page_number = start_page
+            max_pages = end_page - start_page + 1
+            context.log.info(f"Fetching pages {start_page} to {end_page}")
         else:
-            page_number = last_fetched_page - (last_fetched_page % num_pages_to_save)  # Adjust to last saved batch
+            # Resume after the last saved page, if there is one. The checkpoint is only flushed when a batch
+            # is saved, so its next url is the first page of the following batch
+            checkpoint = self._load_checkpoint()
+            if checkpoint.url and not checkpoint.next:
+                # The last page of the endpoint was saved; delete the log file to scrape it again
+                context.log.info(f"{endpoint} was scraped completely up to page {checkpoint.page}, see {self.log_file}")
+                return [] if return_all_data else {"status": "success", "message": "Endpoint already scraped", "pages_fetched": 0}
+            if checkpoint.next:
+                context.log.info(f"Last saved page: {checkpoint.page}")
+                url = checkpoint.next
+                page_number = checkpoint.page + 1
+            else:
+                url = f"{self.base_url}{endpoint}/?{urlencode(params or {})}".rstrip("?")
+                page_number = 1
         total_fetched = 0  # Track the total number of fetched items
         pages_fetched = 0  # Track the number of pages fetched
+        pages_requested = 0  # Track the number of pages requested, including cache hits
+        cache_hits = 0  # Track the number of pages served from the local cache
+        prefetched = {}  # Pending responses of pages requested ahead, keyed by page number
+        endpoint_exhausted = False  # Whether the last page of the endpoint was fetched
 
         # Track time for progress reporting
         start_time = time.time()
 
-        # In case of server side errors, we can delay and retry
-        max_retries = 5  # we will loop through these many times
-        retry_delay = 5  # seconds
-
         # Main loop to go through each page, fetch data and save it to a CSV file
         try:
             while url:
@@ -248,144 +562,205 @@ class APIScraper:
                 if max_pages is not None and pages_fetched >= max_pages:
                     context.log.info(f"Max pages limit reached. Exiting...")
                     break
-                # Handle rate limit
-                if self.request_count >= self.max_requests_per_hour:
-                    print(f"API limit reached. Pausing for 1 hour...")
-                    context.log.info(f"API limit reached. Pausing for 1 hour...")
-                    time.sleep(3600)  # Sleep for 1 hour
-                    self.request_count = 0  # Reset the request count after sleeping
-
-                # Retry mechanism
-                for attempt in range(max_retries):
-                    context.log.info(f"Fetching data from page {page_number}...")
-                    response = self.session.get(url, params=params)
-                    self.request_count += 1
-                    print(f"Request count: {self.request_count}")
-
-                    # Read the response code
-                    # Break if the response is successful
-                    if response.status_code == 200:
-                        break
-                    # If the response indicates a server side error, log the error and retry
-                    elif response.status_code >= 500:
-                        error_message = (
-                            f"Server error {response.status_code}: {response.reason}"
-                        )
-                        context.log.info(error_message)
-                        print(error_message)
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # exponential backoff
-                    else:
-                        # Client side errors are not retried
-                        error_message = (
-                            f"Error {response.status_code}: {response.reason}"
-                        )
-                        print(error_message)
-                        context.log.info(error_message)
-                        raise requests.exceptions.HTTPError(error_message)
+                # Page numbered urls don't depend on the previous page's next link, so the following
+                # pages are kept in flight while this one is processed; cursor links are fetched one at a time
+                current_page = self.get_page_number(url)
+                if current_page not in prefetched:
+                    # The next link doesn't follow the pages requested ahead, so they are dropped.
+                    # Pages that were not sent yet are cancelled and don't count against the limit
+                    for future in prefetched.values():
+                        if future.cancel():
+                            self.release_request()
+                    prefetched = {}
+                    # Handle rate limit; pages already in flight don't need a new request
+                    self.wait_for_rate_limit(context)
+                if current_page is not None:
+                    # Top the window back up as soon as a page is consumed instead of waiting for a whole batch.
+                    # Every page in flight is reserved against the hourly limit, so the window never runs past it
+                    pages_left = MAX_PAGES_IN_FLIGHT if max_pages is None else max_pages - pages_fetched
+                    window_size = min(MAX_PAGES_IN_FLIGHT, pages_left, len(prefetched) + max(0, self.requests_left()))
+                    for page in range(current_page, current_page + window_size):
+                        if page not in prefetched:
+                            self.reserve_request()
+                            prefetched[page] = self.executor.submit(self._fetch_page, self.set_page_number(url, page))
+
+                # Server side errors and rate limits are retried by _get_with_retry
+                context.log.info(f"Fetching data from page {page_number}...")
+                future = prefetched.pop(current_page, None)
+                if future is not None:
+                    response, data = future.result()
                 else:
-                    # If all retries fail, raise an exception
-                    error_message = f"Failed to fetch page {page_number} after {max_retries} attempts."
-                    context.log.info(error_message)
-                    raise requests.exceptions.RetryError(error_message)
-
-                # Reset the retry delay
-                retry_delay = 5
+                    self.reserve_request()
+                    response, data = self._fetch_page(url)
+                pages_requested += 1
+                if getattr(response, "from_cache", False):
+                    # Cached responses don't count against the API limit
+                    cache_hits += 1
+                    context.log.info(f"Page {page_number} served from cache")
+                else:
+                    context.log.debug(f"Requests left this hour: {self.requests_left()}")
 
-                # Read the response data
-                data = response.json()
-                all_data.extend(data.get("results", []))
+                # Client side errors are not retried
+                if response.status_code != 200:
+                    error_message = (
+                        f"Error {response.status_code}: {response.reason}"
+                    )
+                    context.log.info(error_message)
+                    raise requests.exceptions.HTTPError(error_message)
+
+                # The cache and the prefetch workers have already read and decoded the whole body,
+                # so it is released before the page is written, leaving one copy of the page
+                del response, future  # The future holds on to the response too
+
+                # Cursor-paginated responses ignore the page parameter and would silently return page 1
+                if page_range and start_page > 1 and pages_fetched == 0 and "cursor=" in (data.get("next") or ""):
+                    error_message = (
+                        f"{endpoint} is paginated by cursor, so page {start_page} cannot be requested directly. "
+                        "Pass an 'order_by' param that the API paginates by page number."
+                    )
+                    context.log.error(error_message)
+                    raise ValueError(error_message)
+
+                # Write the page to its batch as soon as it is fetched instead of holding the batch in memory
+                if save_logic == 'save_after_pages':
+                    if self._batch_writer is None:
+                        self._batch_writer = self.open_batch_writer(
+                            endpoint,
+                            page_number,
+                            num_pages_to_save,
+                            context,
+                            storage_type=storage_type,
+                            file_format=file_format,
+                            s3_bucket=s3_bucket,
+                            s3_key=s3_key
+                            )
+                    self._batch_writer.write(self.process_data(data.get("results", []), context))
+                if return_all_data:
+                    all_data.extend(data.get("results", []))
 
                 # Update the total number of fetched items
                 total_fetched += len(data.get("results", []))
                 update_message = f"Total items successfully fetched from page {page_number}: {total_fetched}"
                 context.log.info(update_message)
 
-                # Process save logic
-                if save_logic == 'save_after_pages' and page_number % num_pages_to_save == 0:
-                    # Process and save incrementally
-                    self.trigger_save_logic(
-                        endpoint,
-                        all_data,
-                        page_number,
-                        num_pages_to_save,
-                        context,
-                        storage_type=storage_type,
-                        s3_bucket=s3_bucket,
-                        s3_key=s3_key
-                        )
-                    all_data = []  # Reset the data after saving
-
                 # Save next URL and page number
                 self.save_current_next_url_and_page(
                     url, 
-                    data.get("next", "None"), 
+                    data.get("next"), 
                     page_number,
                     context
                 )
+
+                # Process save logic
+                if save_logic == 'save_after_pages' and page_number % num_pages_to_save == 0:
+                    self.trigger_save_logic(context)
+
                 # Handle pagination
                 if "next" in data and data["next"]:
                     url = data["next"]
                     page_number += 1
                     pages_fetched += 1
                 else:
+                    endpoint_exhausted = True
                     break
+            # The last pages fetched may not fill a whole batch. It is saved, but unless the endpoint is exhausted
+            # the checkpoint stays at the previous batch, so a resumed run fetches the whole batch again
+            # instead of overwriting it with its remaining pages
+            self.trigger_save_logic(context, flush_checkpoint=endpoint_exhausted)
         except KeyboardInterrupt:
             context.log.info(f"Process interrupted. Last page URL: {url}, Last fetched page: {page_number}, Total records fetched: {total_fetched}")
         finally:
+            # Pages requested past the last one are not needed
+            for future in prefetched.values():
+                if future.cancel():
+                    self.release_request()
+            # A batch cut short by an error is fetched again on resume, so its partial file is dropped
+            if self._batch_writer is not None:
+                self._batch_writer.discard()
+                self._batch_writer = None
             total_time = time.time() - start_time
             context.log.info(f"Total {total_fetched} records fetched in {total_time/60:.2f} minutes!")
+            context.log.info(f"Cache hits: {cache_hits} of {pages_requested} pages requested")
         if return_all_data:
             return all_data
         else:
-            return {"status": "success", "message": "Data saved to CSV", "pages_fetched": pages_fetched}
+            return {"status": "success", "message": f"Data saved as {file_format}", "pages_fetched": pages_fetched}
 
-    def trigger_save_logic(
+    def open_batch_writer(
         self, 
         endpoint,
-        data,
         page_number,
         num_pages_to_save,
         context,
         storage_type='local',
+        file_format='parquet',
         s3_bucket=None,
         s3_key=None
         ):
         """
-        Save data to CSV based on the page number and save logic.
+        Open the CSV file or parquet partition of the batch of pages that page_number belongs to.
         
         Args:
             endpoint (str): The API endpoint.
-            data (list): The fetched data to save.
-            page_number (int): The current page number.
+            page_number (int): The first page number written to the batch.
             num_pages_to_save (int): How many pages to save in one file.
+            file_format (str, optional): 'parquet' or 'csv'. Defaults to 'parquet'.
+            s3_key (str, optional): Prefix in s3_bucket that every batch gets its own key under.
         """
-        # Process the data
-        processed_data = self.process_data(data,context)
+        # Batches end on multiples of num_pages_to_save, e.g. pages 1-5, 6-10, ...
+        last_page = page_number + (-page_number % num_pages_to_save)
+        first_page = last_page - num_pages_to_save + 1
+
+        if file_format == 'parquet':
+            # Each batch of pages is one partition of the endpoint's dataset, e.g. page_bucket=1-5
+            return ParquetBatchWriter(
+                os.path.join(self.set_data_directory(endpoint,context), "dataset"),
+                page_bucket=f"{first_page}-{last_page}",
+                storage_type=storage_type,
+                s3_bucket=s3_bucket,
+                # Each endpoint's dataset sits under its own prefix, like its local data directory
+                s3_key=f"{s3_key}/{endpoint}/dataset" if s3_key else None
+                )
 
         # Define filename using endpoint and page number
         csv_filename = os.path.join(
             self.set_data_directory(endpoint,context),
-            f"{endpoint}_pages_{page_number - num_pages_to_save + 1}_to_{page_number}.csv"
+            f"{endpoint}_pages_{first_page}_to_{last_page}.csv"
         )
-
-        # Save the data to a CSV file
-        self.save_to_csv(
-            processed_data,
+        return CSVBatchWriter(
             csv_filename,
             storage_type=storage_type,
+            s3_client=self.s3_client,
             s3_bucket=s3_bucket,
-            s3_key=s3_key,
-            context=context
+            s3_key=batch_s3_key(s3_key, csv_filename)
             )
 
+    def trigger_save_logic(self, context, flush_checkpoint=True):
+        """Close the batch being written, then persist the checkpoint now that its pages are saved.
+        flush_checkpoint=False saves an incomplete batch without recording it as progress."""
+        if self._batch_writer is None:
+            return
+        if self._batch_writer.close():
+            context.log.info(f"Data saved to {self._batch_writer.path}")
+        else:
+            context.log.error(f"No data to save for {self._batch_writer.path}")
+        self._batch_writer = None
+        # Progress is only persisted once the pages it covers are saved
+        if flush_checkpoint:
+            self._flush_checkpoint(context)
+
     # Function to process and flatten the data
     def process_data(self,data,context):
         processed_data = []
         for item in data:
-            # Flatten the dictionary and handle missing keys
-            entry = {key: item.get(key, None) for key in item}
-            processed_data.append(entry)
+            # Nested values are stored as JSON so downstream assets can parse them without eval.
+            # Records without nested values are passed through as they are instead of being copied
+            if any(isinstance(value, (dict, list)) for value in item.values()):
+                item = {
+                    key: orjson.dumps(value).decode() if isinstance(value, (dict, list)) else value
+                    for key, value in item.items()
+                }
+            processed_data.append(item)
         processing_message = f"Processed {len(processed_data)} entries"
         context.log.info(processing_message)
         return processed_data
@@ -393,44 +768,48 @@ class APIScraper:
     # Function to save the data to a CSV file
     def save_to_csv(self, data, filename,storage_type='local',s3_bucket=None,s3_key=None,context=None):
         """
-        Save the processed data to a CSV file.
+        Save the processed data to a zstd compressed CSV file.
 
         Args:
             data (list): The list of processed data (dictionaries).
-            filename (str): The name of the CSV file to save the data.
+            filename (str): The name of the CSV file to save the data. Local files get a .zstd suffix.
+            s3_key (str, optional): Prefix in s3_bucket that the file is saved under.
         """
         if not data:
             error_message = f"No data to save for {filename}"
             context.log.error(error_message)
-            print(error_message)
             return
 
-        if storage_type == 'local':
-            # Ensure the directory exists
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            # Write to CSV
-            with open(filename, "w", newline="") as csvfile:
-                fieldnames = data[0].keys()  # Get the column names from the first record
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()  # Write the header
-                for item in data:
-                    writer.writerow(item)  # Write each row
-            success_message = f"Data saved to {filename} in local storage"
-            context.log.info(success_message)
-            print(success_message)
-        elif storage_type == 's3' and s3_bucket and s3_key:
-            try:
-                csv_buffer = io.StringIO()
-                writer = csv.DictWriter(csv_buffer, fieldnames=data[0].keys())
-                writer.writeheader()
-                writer.writerows(data)
-                s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=csv_buffer.getvalue())
-                success_message = f"Data saved to {s3_key} in S3 bucket {s3_bucket}"
-                context.log.info(success_message)
-                print(success_message)
-            except Exception as e:
-                error_message = f"Error saving data to S3: {e}"
-                context.log.error(error_message)
+        if storage_type == 's3':
+            if not (s3_bucket and s3_key):
+                return
+            if self.s3_client is None:
+                context.log.error("An s3_client is required to save data to S3.")
+                return
+        elif storage_type != 'local':
+            return
+
+        # The records are written as a single page, so the header covers the columns of every record, in order
+        writer = CSVBatchWriter(
+            filename,
+            storage_type=storage_type,
+            s3_client=self.s3_client,
+            s3_bucket=s3_bucket,
+            s3_key=batch_s3_key(s3_key, filename)
+            )
+        try:
+            writer.write(data)
+            writer.close()
+        except Exception as e:
+            writer.discard()
+            if storage_type != 's3':
+                raise
+            error_message = f"Error saving data to S3: {e}"
+            context.log.error(error_message)
+            return
+        success_message = f"Data saved to {writer.path}"
+        context.log.info(success_message)
+
 
 class CLScraper(APIScraper):
     """This class is used to scrape data from CourtListener
@@ -438,18 +817,21 @@ class CLScraper(APIScraper):
     using CourtListener's search API. We will create two distinct methods to scrape docket data.
     """
 
-    def __init__(self, api_token, context):
+    def __init__(self, api_token, context, s3_client=None, max_requests_per_hour=5000):
         """
         Initialize the CLScraper.
 
         Args:
             api_token (str): The API token for authentication.
             max_requests_per_hour (int, optional): Maximum number of requests allowed per hour. Defaults to 5000.
+            s3_client (optional): boto3 S3 client used when storage_type is 's3'.
         """
         super().__init__(
             base_url="https://www.courtlistener.com/api/rest/v4/",
             api_token=api_token,
-            context=context
+            max_requests_per_hour=max_requests_per_hour,
+            context=context,
+            s3_client=s3_client
         )
 
     def fetch_positions(
@@ -459,7 +841,10 @@ class CLScraper(APIScraper):
         save_logic= 'save_after_pages', # Possible options are 'author_level' or 'save_after_pages'
         num_pages_to_save = 5,
         max_pages = 20,
+        start_page = None,
+        end_page = None,
         storage_type='local',
+        file_format='parquet',
         s3_bucket=None, 
         s3_key=None, 
         **kwargs
@@ -468,6 +853,9 @@ class CLScraper(APIScraper):
         Fetch positions data from the CourtListener API.
 
         Args:
+            start_page (int, optional): First page of the range to fetch. Requires end_page.
+            end_page (int, optional): Last page of the range to fetch. Overrides max_pages.
+            file_format (str, optional): 'parquet' to save into data/positions/dataset, or 'csv'. Defaults to 'parquet'.
             **kwargs: Additional query parameters for the API request.
 
         Returns:
@@ -483,8 +871,11 @@ class CLScraper(APIScraper):
             save_logic= 'save_after_pages',
             num_pages_to_save = num_pages_to_save, # Required argument if save_logic is 'save_after_pages'; save a csv after every 20 pages
             max_pages = max_pages,
+            start_page = start_page,
+            end_page = end_page,
             return_all_data = False, # we don't need to assign a variable to the return value
             storage_type=storage_type,
+            file_format=file_format,
             s3_bucket=s3_bucket,
             s3_key=s3_key,
             params=params)
@@ -497,6 +888,7 @@ class CLScraper(APIScraper):
         num_pages_to_save = 5,
         max_pages = 20,
         storage_type='local',
+        file_format='parquet',
         s3_bucket=None,
         s3_key=None,
         **kwargs):
@@ -504,6 +896,8 @@ class CLScraper(APIScraper):
         Fetch financial disclosures data from the CourtListener API.
 
         Args:
+            file_format (str, optional): 'parquet' to save into data/financial-disclosures/dataset, or 'csv'.
+                                         Defaults to 'parquet'.
             **kwargs: Additional query parameters for the API request.
 
         Returns:
@@ -521,6 +915,7 @@ class CLScraper(APIScraper):
             max_pages = max_pages,
             return_all_data = False, # we don't need to assign a variable to the return value
             storage_type=storage_type,
+            file_format=file_format,
             s3_bucket=s3_bucket,
             s3_key=s3_key,
             params=params)
@@ -575,8 +970,46 @@ class CLScraper(APIScraper):
         self.save_to_csv(data=self.process_data(all_data), filename=csv_filename)
         success_message = f"Data for author_id {author_id} saved to {csv_filename}"
         context.log.info(success_message)
-        print(success_message)
 
-#@resource
-#def cl_scraper_resource(init_context):
-#    return CLScraper(api_key=init_context.resource_config["api_key"])  
\ No newline at end of file
+@resource(
+    config_schema={
+        "api_token": StringSource,
+        "max_requests_per_hour": Field(
+            IntSource, default_value=5000, description="Hourly request limit of the API token, shared by all scrapers."
+        ),
+        "concurrent_scrapers": Field(
+            IntSource,
+            default_value=2,
+            description="How many scrapers can run at once; match the courtlistener_api limits in dagster.yaml.",
+        ),
+    },
+    required_resource_keys={"s3"},
+)
+def cl_scraper_resource(init_context):
+    """A CLScraper for each step that uses it. The multiprocess executor starts the resource in every step
+    process, so each scrape asset gets its own session and connection pool over the shared on-disk cache.
+    The session is closed on teardown."""
+    config = init_context.resource_config
+    if config["concurrent_scrapers"] < 1:
+        error_message = f"concurrent_scrapers must be at least 1, got {config['concurrent_scrapers']}"
+        init_context.log.error(error_message)
+        raise ValueError(error_message)
+    # Every scraper process tracks its own requests, so each gets an equal share of the token's limit
+    requests_per_scraper = config["max_requests_per_hour"] // config["concurrent_scrapers"]
+    if requests_per_scraper < 1:
+        error_message = (
+            f"max_requests_per_hour ({config['max_requests_per_hour']}) leaves no requests for each of "
+            f"{config['concurrent_scrapers']} concurrent scrapers"
+        )
+        init_context.log.error(error_message)
+        raise ValueError(error_message)
+    scraper = CLScraper(
+        api_token=config["api_token"],
+        context=init_context,
+        s3_client=init_context.resources.s3.get_client(),
+        max_requests_per_hour=requests_per_scraper,
+    )
+    try:
+        yield scraper
+    finally:
+        scraper.close()
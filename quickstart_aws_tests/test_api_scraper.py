@@ -0,0 +1,262 @@
+import csv
+import io
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+import orjson
+import pyarrow.dataset as ds
+import pytest
+import requests
+import zstandard as zstd
+from dagster import build_init_resource_context
+
+from cl_wrappers_aws.resources.api_scraper import CSV_ZSTD_SUFFIX, APIScraper, cl_scraper_resource
+
+BASE_URL = "https://api.example.com/"
+ENDPOINT = "positions"
+ROWS_PER_PAGE = 3
+
+
+@pytest.fixture
+def context():
+    return SimpleNamespace(log=logging.getLogger("test_api_scraper"))
+
+
+@pytest.fixture
+def scraper(tmp_path, monkeypatch, context):
+    # The scraper writes its cache, logs and data relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    scraper = APIScraper(base_url=BASE_URL, context=context)
+    yield scraper
+    scraper.close()
+
+
+def serve_pages(scraper, monkeypatch, last_page):
+    """Serve a cursor paginated endpoint of last_page pages, recording the pages requested."""
+    requested = []
+
+    def fetch_page(url):
+        page = int(dict(parse_qsl(urlsplit(url).query)).get("cursor", 1))
+        requested.append(page)
+        data = {
+            "results": [{"id": f"{page}-{row}", "page": page} for row in range(ROWS_PER_PAGE)],
+            "next": f"{BASE_URL}{ENDPOINT}/?cursor={page + 1}" if page < last_page else None,
+        }
+        return SimpleNamespace(status_code=200, reason="OK", from_cache=False), data
+
+    monkeypatch.setattr(scraper, "_fetch_page", fetch_page)
+    return requested
+
+
+def saved_pages(scraper, context):
+    """Return the pages saved to each page_bucket of the endpoint's dataset."""
+    dataset_dir = f"{scraper.set_data_directory(ENDPOINT, context)}/dataset"
+    table = ds.dataset(dataset_dir, format="parquet", partitioning="hive").to_table()
+    buckets = {}
+    for bucket, page in zip(table.column("page_bucket").to_pylist(), table.column("page").to_pylist()):
+        buckets.setdefault(bucket, set()).add(int(page))
+    return buckets
+
+
+def fetch(scraper, context, max_pages):
+    return scraper.fetch_data(ENDPOINT, num_pages_to_save=5, max_pages=max_pages, context=context)
+
+
+def test_resume_continues_after_the_last_saved_batch(scraper, monkeypatch, context):
+    requested = serve_pages(scraper, monkeypatch, last_page=30)
+    fetch(scraper, context, max_pages=10)
+
+    requested.clear()
+    fetch(scraper, context, max_pages=10)
+
+    assert requested == list(range(11, 21))
+    assert saved_pages(scraper, context) == {
+        "1-5": {1, 2, 3, 4, 5},
+        "6-10": {6, 7, 8, 9, 10},
+        "11-15": {11, 12, 13, 14, 15},
+        "16-20": {16, 17, 18, 19, 20},
+    }
+
+
+def test_resume_refetches_a_batch_that_was_cut_short(scraper, monkeypatch, context):
+    requested = serve_pages(scraper, monkeypatch, last_page=30)
+    fetch(scraper, context, max_pages=7)
+    assert saved_pages(scraper, context)["6-10"] == {6, 7}
+
+    requested.clear()
+    fetch(scraper, context, max_pages=5)
+
+    assert requested == [6, 7, 8, 9, 10]
+    assert saved_pages(scraper, context) == {"1-5": {1, 2, 3, 4, 5}, "6-10": {6, 7, 8, 9, 10}}
+
+
+def test_resume_stops_once_the_endpoint_is_exhausted(scraper, monkeypatch, context):
+    requested = serve_pages(scraper, monkeypatch, last_page=8)
+    fetch(scraper, context, max_pages=None)
+    assert saved_pages(scraper, context) == {"1-5": {1, 2, 3, 4, 5}, "6-10": {6, 7, 8}}
+
+    requested.clear()
+    result = fetch(scraper, context, max_pages=None)
+
+    assert requested == []
+    assert result["pages_fetched"] == 0
+    assert saved_pages(scraper, context) == {"1-5": {1, 2, 3, 4, 5}, "6-10": {6, 7, 8}}
+
+
+def test_failed_rerun_keeps_the_previous_partition(scraper, monkeypatch, context):
+    failing_page = None
+
+    def get_with_retry(url):
+        page = int(dict(parse_qsl(urlsplit(url).query))["page"])
+        if page == failing_page:
+            return SimpleNamespace(status_code=404, reason="Not Found", from_cache=False, content=b"")
+        body = {"results": [{"id": page, "page": page}], "next": f"{BASE_URL}{ENDPOINT}/?page={page + 1}"}
+        return SimpleNamespace(status_code=200, reason="OK", from_cache=False, content=orjson.dumps(body))
+
+    monkeypatch.setattr(scraper, "_get_with_retry", get_with_retry)
+    scraper.fetch_data(ENDPOINT, num_pages_to_save=5, start_page=1, end_page=5, context=context)
+
+    failing_page = 3
+    with pytest.raises(requests.exceptions.HTTPError):
+        scraper.fetch_data(ENDPOINT, num_pages_to_save=5, start_page=1, end_page=5, context=context)
+
+    assert saved_pages(scraper, context) == {"1-5": {1, 2, 3, 4, 5}}
+
+
+def test_every_csv_batch_gets_its_own_s3_key(scraper, monkeypatch, context):
+    serve_pages(scraper, monkeypatch, last_page=10)
+    uploaded = []
+    scraper.s3_client = SimpleNamespace(upload_fileobj=lambda file, bucket, key, **kwargs: uploaded.append(key))
+
+    scraper.fetch_data(
+        ENDPOINT, num_pages_to_save=5, storage_type="s3", file_format="csv", s3_bucket="bucket", s3_key="raw",
+        context=context,
+    )
+
+    assert uploaded == ["raw/positions_pages_1_to_5.csv.zstd", "raw/positions_pages_6_to_10.csv.zstd"]
+
+
+def test_save_to_csv_writes_through_the_batch_writer(scraper, context, tmp_path):
+    filename = str(tmp_path / "data" / "author.csv")
+
+    scraper.save_to_csv([{"id": 1}, {"id": 2, "name": "b"}], filename, context=context)
+
+    with open(filename + CSV_ZSTD_SUFFIX, "rb") as file:
+        text = zstd.ZstdDecompressor().stream_reader(file).read().decode()
+    assert list(csv.DictReader(io.StringIO(text))) == [{"id": "1", "name": ""}, {"id": "2", "name": "b"}]
+
+
+class RateLimitReached(Exception):
+    pass
+
+
+# With a jump of MAX_PAGES_IN_FLIGHT the next links skip the pages requested ahead, which are dropped after being sent
+@pytest.mark.parametrize("jump", [1, 16])
+def test_pages_requested_ahead_stay_within_the_hourly_limit(scraper, monkeypatch, context, jump):
+    sent = []
+
+    def get_with_retry(url):
+        page = int(dict(parse_qsl(urlsplit(url).query))["page"])
+        sent.append(page)
+        body = {"results": [{"id": page}], "next": f"{BASE_URL}{ENDPOINT}/?order_by=id&page={page + jump}"}
+        return SimpleNamespace(status_code=200, reason="OK", from_cache=False, content=orjson.dumps(body))
+
+    def sleep(seconds):
+        raise RateLimitReached
+
+    monkeypatch.setattr(scraper, "_get_with_retry", get_with_retry)
+    monkeypatch.setattr("cl_wrappers_aws.resources.api_scraper.time.sleep", sleep)
+    # More than MAX_PAGES_IN_FLIGHT, so the window is topped up while earlier pages are still in flight
+    scraper.max_requests_per_hour = 20
+
+    with pytest.raises(RateLimitReached):
+        scraper.fetch_data(
+            ENDPOINT, params={"order_by": "id"}, num_pages_to_save=5, start_page=1, end_page=400, context=context
+        )
+
+    assert len(sent) <= 20
+
+
+def test_resource_splits_the_hourly_limit_between_concurrent_scrapers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    init_context = build_init_resource_context(
+        config={"api_token": "token", "max_requests_per_hour": 5000, "concurrent_scrapers": 2},
+        resources={"s3": SimpleNamespace(get_client=lambda: None)},
+    )
+
+    with cl_scraper_resource(init_context) as scraper:
+        assert scraper.max_requests_per_hour == 2500
+
+
+@pytest.mark.parametrize("max_requests_per_hour, concurrent_scrapers", [(5000, 0), (5000, -1), (1, 2)])
+def test_resource_rejects_a_split_without_requests(tmp_path, monkeypatch, max_requests_per_hour, concurrent_scrapers):
+    monkeypatch.chdir(tmp_path)
+    init_context = build_init_resource_context(
+        config={
+            "api_token": "token",
+            "max_requests_per_hour": max_requests_per_hour,
+            "concurrent_scrapers": concurrent_scrapers,
+        },
+        resources={"s3": SimpleNamespace(get_client=lambda: None)},
+    )
+
+    with pytest.raises(ValueError):
+        with cl_scraper_resource(init_context):
+            pass
+
+
+@pytest.fixture
+def flaky_server():
+    """A local server answering each path with the statuses queued for it, then 200 once they run out."""
+    statuses = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            queued = statuses.get(self.path, [])
+            status = queued.pop(0) if queued else 200
+            body = orjson.dumps({"results": [], "next": None})
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/", statuses
+    server.shutdown()
+    server.server_close()
+
+
+def test_retry_backoff_starts_over_for_every_page(tmp_path, monkeypatch, context, flaky_server):
+    base_url, statuses = flaky_server
+    monkeypatch.chdir(tmp_path)
+    scraper = APIScraper(base_url=base_url, context=context)
+    backoffs = []
+    monkeypatch.setattr("urllib3.util.retry.time.sleep", backoffs.append)
+    statuses["/positions/?page=1"] = [503, 503, 503]
+    statuses["/positions/?page=2"] = [503, 503]
+    statuses["/positions/?page=3"] = [503] * 10
+
+    try:
+        assert scraper._get_with_retry(f"{base_url}positions/?page=1").status_code == 200
+        assert backoffs == [3.0, 6.0]
+
+        # A page retried after a bad one waits as long as if it came first
+        backoffs.clear()
+        assert scraper._get_with_retry(f"{base_url}positions/?page=2").status_code == 200
+        assert backoffs == [3.0]
+
+        backoffs.clear()
+        with pytest.raises(requests.exceptions.RetryError):
+            scraper._get_with_retry(f"{base_url}positions/?page=3")
+        assert backoffs == [3.0, 6.0, 12.0, 24.0]
+    finally:
+        scraper.close()
@@ -0,0 +1,95 @@
+import ast
+import logging
+from types import SimpleNamespace
+
+import orjson
+import pandas as pd
+import pytest
+
+from cl_wrappers_aws.assets import cl_transform
+from cl_wrappers_aws.resources.api_scraper import CSVBatchWriter, ParquetBatchWriter
+
+
+def test_csv_batch_round_trips_through_positions_dataset(tmp_path, monkeypatch):
+    positions_dir = tmp_path / "positions"
+    monkeypatch.setattr(cl_transform, "LEGACY_POSITIONS_DIR", positions_dir)
+    monkeypatch.setattr(cl_transform, "POSITIONS_DATASET_DIR", positions_dir / "dataset")
+
+    records = [
+        {
+            "id": position_id,
+            "person": orjson.dumps({"id": position_id, "slug": f"judge-{position_id}"}).decode(),
+            "court": "scotus",
+            "position_type": "jud",
+            "job_title": "",
+            "organization_name": None,
+            "date_start": "1990-01-01",
+            "date_termination": None,
+        }
+        for position_id in range(5000)
+    ]
+    writer = CSVBatchWriter(str(positions_dir / "positions_pages_1_to_5.csv"))
+    writer.write(records[:2500])
+    writer.write(records[2500:])
+    assert writer.close()
+
+    table = cl_transform.positions_dataset().to_table()
+
+    assert table.num_rows == 5000
+    assert table.column("id").to_pylist() == [str(record["id"]) for record in records]
+    assert orjson.loads(table.column("person")[0].as_py()) == {"id": 0, "slug": "judge-0"}
+
+
+def test_dataset_version_only_changes_with_the_pages(tmp_path, monkeypatch):
+    positions_dir = tmp_path / "positions"
+    monkeypatch.setattr(cl_transform, "LEGACY_POSITIONS_DIR", positions_dir)
+    monkeypatch.setattr(cl_transform, "POSITIONS_DATASET_DIR", positions_dir / "dataset")
+
+    def scrape(records):
+        writer = ParquetBatchWriter(str(positions_dir / "dataset"), page_bucket="1-5")
+        writer.write(records)
+        assert writer.close()
+        return cl_transform.dataset_version(cl_transform.positions_dataset())
+
+    records = [{"id": position_id, "court": "scotus"} for position_id in range(100)]
+    version = scrape(records)
+
+    # A re-run served from the cache rewrites the partition with the same pages
+    assert scrape(records) == version
+    assert scrape(records[:50]) != version
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        """{'a': "x', 'b': 'y"}""",
+        "{'bio': 'Served 1990, True, then'}",
+        "{'id': 7, 'race': ['w', 'b'], 'name_suffix': None, 'is_alias': False, 'has_photo': True}",
+    ],
+)
+def test_parse_person_matches_python_dict_literals(value):
+    assert cl_transform.parse_person(value) == ast.literal_eval(value)
+
+
+def test_parse_person_reads_json():
+    assert cl_transform.parse_person('{"id": 7, "race": null}') == {"id": 7, "race": None}
+
+
+@pytest.mark.parametrize(
+    "person",
+    [
+        '{"id": 7, "slug": "jane-doe", "race": ["w"], "gender": "f", "education": []}',
+        "{'id': 7, 'slug': 'jane-doe', 'race': ['w'], 'gender': 'f', 'education': []}",
+    ],
+)
+def test_parse_persons_keeps_a_row_for_null_and_blank_cells(person):
+    context = SimpleNamespace(log=logging.getLogger("test_cl_transform"))
+
+    person_df = cl_transform.parse_persons(pd.Series([None, "", person, "  "]), context)
+
+    assert list(person_df.columns) == list(cl_transform.PERSON_FIELDS)
+    assert len(person_df) == 4
+    assert person_df["id"].isna().tolist() == [True, True, False, True]
+    assert person_df.loc[2, "id"] == 7
+    assert person_df.loc[2, "slug"] == "jane-doe"
+    assert list(person_df.loc[2, "race"]) == ["w"]
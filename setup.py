@@ -8,8 +8,15 @@ setup(
         "dagster-aws",
         "dagster-cloud",
         "pandas",
-        "matplotlib",
-        "requests"
+        "pyarrow",
+        "orjson",
+        "requests",
+        "requests-cache",
+        "zstandard",
     ],
-    extras_require={"dev": ["dagster-webserver", "pytest"]},
+    extras_require={
+        "dev": ["dagster-webserver", "pytest"],
+        # Only the summary stats asset plots, so matplotlib stays out of the scrape and transform images
+        "plots": ["matplotlib"],
+    },
 )